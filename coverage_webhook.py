@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""
+Receives GitLab 'Pipeline Hook' events and caches finished coverage per commit,
+so fail_on_coverage can look up the reference hash instead of polling the API.
+Run this somewhere GitLab can reach, and register it once with --register.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+CACHE_FILENAME = os.path.expanduser("~/.cache/coverage_tools/coverage_cache.json")
+HOOKS_URL = "https://gitlab.com/api/v4/projects/{0}/hooks"
+COVERAGE_STAGE = "coverage"
+
+
+def _read_cache():
+    try:
+        with open(CACHE_FILENAME) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_cached_coverage(reference_hash):
+    """Return the cached coverage for a commit hash, or None on a cache miss"""
+    return _read_cache().get(reference_hash)
+
+
+def store_coverage(reference_hash, coverage):
+    """Add {hash: coverage} to the cache file, writing via an atomic rename"""
+    cache = _read_cache()
+    cache[reference_hash] = coverage
+    cache_dir = os.path.dirname(CACHE_FILENAME)
+    os.makedirs(cache_dir, exist_ok=True)
+    handle, temp_name = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(handle, "w") as temp_file:
+        json.dump(cache, temp_file)
+    os.replace(temp_name, CACHE_FILENAME)
+
+
+def _extract_coverage(payload):
+    """Pull (sha, coverage) out of a pipeline event, or (None, None) if it isn't
+    a successful pipeline with a finished coverage job"""
+    if payload.get("object_kind") != "pipeline":
+        return None, None
+    attributes = payload.get("object_attributes", {})
+    if attributes.get("status") != "success":
+        return None, None
+    for build in payload.get("builds", []):
+        if (
+            build.get("stage") == COVERAGE_STAGE
+            and build.get("status") == "success"
+            and build.get("coverage") is not None
+        ):
+            return attributes.get("sha"), build["coverage"]
+    return None, None
+
+
+class PipelineHookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        reference_hash, coverage = _extract_coverage(payload)
+        if reference_hash is not None:
+            store_coverage(reference_hash, coverage)
+            print(f"cached coverage {coverage} for {reference_hash}")
+        self.send_response(200)
+        self.end_headers()
+
+
+def register_webhook(gitlab_project_id, gitlab_token, url):
+    """Register this receiver for pipeline events on the project"""
+    response = requests.post(
+        HOOKS_URL.format(gitlab_project_id),
+        params={"private_token": gitlab_token},
+        data={"url": url, "pipeline_events": True},
+    )
+    if response.status_code not in (200, 201):
+        raise Exception("Could not register webhook: " + response.text)
+    print(f"registered pipeline webhook {url}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument(
+        "--register", help="Public URL of this receiver to register with GitLab"
+    )
+    parser.add_argument("--gitlab-project-id", help="The Gitlab project id")
+    parser.add_argument("--gitlab-token", help="The Gitlab API token")
+    args = parser.parse_args()
+
+    if args.register:
+        register_webhook(args.gitlab_project_id, args.gitlab_token, args.register)
+
+    print(f"listening for pipeline hooks on port {args.port}")
+    HTTPServer(("", args.port), PipelineHookHandler).serve_forever()  # nosec
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,74 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import json
+import os
 import subprocess
 import sys
+import tempfile
 import time
 
+import coverage_webhook
 import get_diff_coverage
 import get_exact_coverage
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # noticeably faster than stdlib json on big status arrays
+except ImportError:
+    orjson = None
 
 PIPELINE_STATUS_URL = "https://gitlab.com/api/v4/projects/{0}/repository/commits/{1}/statuses?stage=coverage"
 PIPELINE_MERGE_REQUEST_URL = (
     "https://gitlab.com/api/v4/projects/{0}/merge_requests?source_branch={1}"
 )
 DEFAULT_TARGET_BRANCH = "main"
+POLL_INITIAL_DELAY = 2
+POLL_MAX_DELAY = 30
+GITLAB_CACHE_FILENAME = os.path.expanduser("~/.cache/coverage_tools/gitlab_cache.json")
+
+
+def _read_gitlab_cache():
+    try:
+        with open(GITLAB_CACHE_FILENAME) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_gitlab_cache(cache):
+    cache_dir = os.path.dirname(GITLAB_CACHE_FILENAME)
+    os.makedirs(cache_dir, exist_ok=True)
+    handle, temp_name = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(handle, "w") as temp_file:
+        json.dump(cache, temp_file)
+    os.replace(temp_name, GITLAB_CACHE_FILENAME)
 
-def get_merge_base(target_branch):
+
+def make_session(gitlab_token):
+    """Build a session so repeated polls reuse one keep-alive connection to gitlab"""
+    session = requests.Session()
+    session.params = {"private_token": gitlab_token, "membership": "yes"}
+    session.headers["User-Agent"] = "coverage-tools"
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=10,
+            max_retries=Retry(
+                total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]
+            ),
+        ),
+    )
+    return session
+
+def get_merge_base(target_branch, fetched_branch=None):
     target_branch = target_branch or DEFAULT_TARGET_BRANCH
-    subprocess.check_call(["git", "fetch", "origin", target_branch])
+    if target_branch != fetched_branch:
+        subprocess.check_call(["git", "fetch", "origin", target_branch])
     return (
         subprocess.check_output(
             ["git", "merge-base", "HEAD", "origin/" + target_branch]
@@ -43,22 +94,28 @@ def has_coverage(commit):
     )
 
 
-def get_results(api_url, gitlab_project_id, reference_hash, gitlab_token):
-    params = {"private_token": gitlab_token, "membership": "yes"}
-    request = requests.get(
-        api_url.format(gitlab_project_id, reference_hash), params=params
-    )
+def get_results(session, api_url, gitlab_project_id, reference_hash):
+    request = session.get(api_url.format(gitlab_project_id, reference_hash))
     print("status code:", request.status_code)
     if request.status_code != 200:
         raise Exception("Could not find any commit status for hash: " + reference_hash)
+    if orjson is not None:
+        return orjson.loads(request.content)
     return request.json()
 
 
-def get_latest_coverage(gitlab_project_id, reference_hash, gitlab_token):
+def get_latest_coverage(session, gitlab_project_id, reference_hash):
+    # a webhook receiver may already have cached this commit's coverage
+    cached = coverage_webhook.get_cached_coverage(reference_hash)
+    if cached is not None:
+        print(f"Found webhook-cached coverage for {reference_hash}")
+        return cached
+
     statuses = get_results(
-        PIPELINE_STATUS_URL, gitlab_project_id, reference_hash, gitlab_token
+        session, PIPELINE_STATUS_URL, gitlab_project_id, reference_hash
     )
     waiting = False
+    delay = POLL_INITIAL_DELAY
     while True:
         matching_statuses = [s for s in statuses if has_coverage(s)]
         if matching_statuses:
@@ -69,9 +126,12 @@ def get_latest_coverage(gitlab_project_id, reference_hash, gitlab_token):
                 waiting = True
             else:
                 print(".", end="", flush=True)
-            time.sleep(20)
+            # back off exponentially: catch jobs that finish quickly without
+            # hammering the API on long-running ones
+            time.sleep(delay)
+            delay = min(delay * 2, POLL_MAX_DELAY)
             statuses = get_results(
-                PIPELINE_STATUS_URL, gitlab_project_id, reference_hash, gitlab_token
+                session, PIPELINE_STATUS_URL, gitlab_project_id, reference_hash
             )
         elif statuses:
             # no coverage because all jobs failed
@@ -84,10 +144,37 @@ def get_latest_coverage(gitlab_project_id, reference_hash, gitlab_token):
     return latest["coverage"]
 
 
-def get_target_branch(gitlab_project_id, current_branch, gitlab_token):
-    merge_request = get_results(
-        PIPELINE_MERGE_REQUEST_URL, gitlab_project_id, current_branch, gitlab_token
+def get_target_branch(session, gitlab_project_id, current_branch):
+    # gitlab supports conditional GETs, so send the ETag from the last run and
+    # reuse the cached body on a 304 Not Modified
+    cache_key = "{0}/{1}".format(gitlab_project_id, current_branch)
+    cache = _read_gitlab_cache()
+    cached = cache.get(cache_key, {})
+    headers = {"If-None-Match": cached["etag"]} if "etag" in cached else {}
+
+    response = session.get(
+        PIPELINE_MERGE_REQUEST_URL.format(gitlab_project_id, current_branch),
+        headers=headers,
     )
+    print("status code:", response.status_code)
+    if response.status_code == 304:
+        merge_request = cached["body"]
+    else:
+        if response.status_code != 200:
+            raise Exception(
+                "Could not find any merge request for branch: " + current_branch
+            )
+        if orjson is not None:
+            merge_request = orjson.loads(response.content)
+        else:
+            merge_request = response.json()
+        if "ETag" in response.headers:
+            cache[cache_key] = {
+                "etag": response.headers["ETag"],
+                "body": merge_request,
+            }
+            _write_gitlab_cache(cache)
+
     if merge_request and "target_branch" in merge_request[0]:
         return merge_request[0]["target_branch"]
     return None
@@ -116,14 +203,28 @@ def main():
         None if args.override_threshold is None else float(args.override_threshold)
     )
 
-    target_branch = get_target_branch(project_id, branch, token)
+    with make_session(token) as session:
+        # fetching the likely target branch and looking up the merge request are
+        # independent network calls, so run them concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            fetch_future = executor.submit(
+                subprocess.check_call,
+                ["git", "fetch", "origin", DEFAULT_TARGET_BRANCH],
+            )
+            target_branch_future = executor.submit(
+                get_target_branch, session, project_id, branch
+            )
+            target_branch = target_branch_future.result()
+            fetch_future.result()
 
-    if override_threshold:
-        reference_hash = "(using override coverage)"
-        coverage = override_threshold
-    else:
-        reference_hash = get_merge_base(target_branch)
-        coverage = get_latest_coverage(project_id, reference_hash, token)
+        if override_threshold:
+            reference_hash = "(using override coverage)"
+            coverage = override_threshold
+        else:
+            reference_hash = get_merge_base(
+                target_branch, fetched_branch=DEFAULT_TARGET_BRANCH
+            )
+            coverage = get_latest_coverage(session, project_id, reference_hash)
 
     coverage = round(coverage, 4)
     print(f"coverage on reference hash {reference_hash}={coverage}")
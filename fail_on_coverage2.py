@@ -6,7 +6,15 @@ import sys
 import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+try:
+    import orjson  # noticeably faster than stdlib json on big status arrays
+except ImportError:
+    orjson = None
+
+import coverage_webhook
 import get_diff_coverage2
 
 PIPELINE_STATUS_URL = (
@@ -17,6 +25,26 @@ PIPELINE_MERGE_REQUEST_URL = (
 )
 COVERAGE_XML_FILENAME = "target/coverage.xml"
 ORIGIN_MAIN_BRANCH = "origin/main"
+POLL_INITIAL_DELAY = 2
+POLL_MAX_DELAY = 30
+
+
+def make_session(gitlab_token):
+    """Build a session so repeated polls reuse one keep-alive connection to gitlab"""
+    session = requests.Session()
+    session.params = {"private_token": gitlab_token, "membership": "yes"}
+    session.headers["User-Agent"] = "coverage-tools"
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=10,
+            max_retries=Retry(
+                total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]
+            ),
+        ),
+    )
+    return session
 
 
 def get_merge_base():
@@ -39,22 +67,28 @@ def has_coverage(commit):
     return commit["status"] == "success" and commit["coverage"] is not None
 
 
-def get_results(api_url, gitlab_project_id, reference_hash, gitlab_token):
-    params = {"private_token": gitlab_token, "membership": "yes"}
-    request = requests.get(
-        api_url.format(gitlab_project_id, reference_hash), params=params
-    )
+def get_results(session, api_url, gitlab_project_id, reference_hash):
+    request = session.get(api_url.format(gitlab_project_id, reference_hash))
     if request.status_code != 200:
         print("status code:", request.status_code)
         raise Exception("Could not find any commit status for hash: " + reference_hash)
+    if orjson is not None:
+        return orjson.loads(request.content)
     return request.json()
 
 
-def get_latest_coverage(gitlab_project_id, reference_hash, gitlab_token):
+def get_latest_coverage(session, gitlab_project_id, reference_hash):
+    # a webhook receiver may already have cached this commit's coverage
+    cached = coverage_webhook.get_cached_coverage(reference_hash)
+    if cached is not None:
+        print(f"Found webhook-cached coverage for {reference_hash}")
+        return cached
+
     statuses = get_results(
-        PIPELINE_STATUS_URL, gitlab_project_id, reference_hash, gitlab_token
+        session, PIPELINE_STATUS_URL, gitlab_project_id, reference_hash
     )
     waiting = False
+    delay = POLL_INITIAL_DELAY
     while True:
         matching_statuses = [s for s in statuses if has_coverage(s)]
         if matching_statuses:
@@ -65,9 +99,12 @@ def get_latest_coverage(gitlab_project_id, reference_hash, gitlab_token):
                 waiting = True
             else:
                 print(".", end="", flush=True)
-            time.sleep(20)
+            # back off exponentially: catch jobs that finish quickly without
+            # hammering the API on long-running ones
+            time.sleep(delay)
+            delay = min(delay * 2, POLL_MAX_DELAY)
             statuses = get_results(
-                PIPELINE_STATUS_URL, gitlab_project_id, reference_hash, gitlab_token
+                session, PIPELINE_STATUS_URL, gitlab_project_id, reference_hash
             )
         elif statuses:
             # no coverage because all jobs failed
@@ -102,7 +139,8 @@ def main():
 
     reference_hash = get_merge_base()
     print(f"Merge base is {reference_hash}")
-    coverage = get_latest_coverage(project_id, reference_hash, token)
+    with make_session(token) as session:
+        coverage = get_latest_coverage(session, project_id, reference_hash)
 
     coverage = round(coverage, 4)
     print(f"coverage on reference hash {reference_hash} is {coverage}%")
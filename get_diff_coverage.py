@@ -1,24 +1,68 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import functools
+import linecache
 import math
 import re
 import subprocess
 import xml.etree.ElementTree as xml_parser  # noqa
-from collections import Counter, OrderedDict
-from itertools import chain
+from collections import namedtuple
+
+# group/package/filename as defined in jacoco's report, compiled once since
+# it's matched against every changed file
+_JAVA_PATH_RE = re.compile(r"(.*?)/src/.*?/((?:com|ca)/.*)\/(.*?\.java)")
+
+# the covered and uncovered line numbers of one source file, as sets so that
+# reconciliation is bulk set intersections instead of a per-line Python loop
+FileCoverage = namedtuple("FileCoverage", ["covered", "uncovered"])
+
+_EMPTY_COVERAGE = FileCoverage(frozenset(), frozenset())
+
+# plain int counts of reconciled lines; cheaper than a Counter in the hot path
+LineStats = namedtuple("LineStats", ["covered", "uncovered", "ignored"])
 
 
 def _parse_coverage(file_name):
-    return xml_parser.parse(file_name).getroot()
+    """
+    Stream the jacoco coverage xml into a flat index of
+    (group, package, file name) -> FileCoverage, clearing elements as we go so
+    the full report never sits in memory at once
+    """
+    coverage_index = {}
+    group = package = None
+    for event, element in xml_parser.iterparse(file_name, events=("start", "end")):
+        if event == "start":
+            if element.tag == "group":
+                group = element.get("name")
+            elif element.tag == "package":
+                package = element.get("name")
+        elif element.tag == "sourcefile":
+            covered = set()
+            uncovered = set()
+            for line in element.findall("line"):
+                line_number = int(line.attrib["nr"])
+                # We considered Covered = True if there are no missed instructions(mi) or missed branches(mb) in jacoco's info
+                if line.attrib["mi"] == "0" and line.attrib["mb"] == "0":
+                    covered.add(line_number)
+                else:
+                    uncovered.add(line_number)
+            coverage_index[(group, package, element.get("name"))] = FileCoverage(
+                frozenset(covered), frozenset(uncovered)
+            )
+            element.clear()
+        elif element.tag == "package":
+            element.clear()
+    return coverage_index
 
 
-def _get_coverage_map(tree, file):
+def _get_file_coverage(coverage_index, file):
     """
-    Get a map of which lines are covered for a specified file
-    :param tree: an element tree for the jacoco coverage report xml
+    Get the coverage information for a specified file
+    :param coverage_index: the coverage index built by _parse_coverage
     :param file: the file to find coverage for
-    :return: a map of int -> boolean with a key of lines we have info for and value of whether or not it's covered
+    :return: a FileCoverage of covered/uncovered line sets, or None if the file can't have coverage
     """
 
     # skip files that are in the root directory
@@ -26,7 +70,7 @@ def _get_coverage_map(tree, file):
         return None
 
     # split file into group/package/filename as defined in jacoco's report
-    file_info = re.search(r"(.*?)/src/.*?/((?:com|ca)/.*)\/(.*?\.java)", file)
+    file_info = _JAVA_PATH_RE.search(file)
 
     # skip files that don't match this
     if not file_info or len(file_info.groups()) != 3:
@@ -35,105 +79,120 @@ def _get_coverage_map(tree, file):
     group, package, file_name = file_info.groups()
     group = group.split("/")[-1]
 
-    # look up the source file info in the report
-    lookup = "group[@name='{}']/package[@name='{}']/sourcefile[@name='{}']".format(
-        group, package, file_name
-    )
-    source_tree = tree.find(lookup)
+    # look up the source file info in the index
+    key = (group, package, file_name)
+    if key not in coverage_index:
+        print("Couldn't find a test coverage file for " + "/".join(key))
+        return _EMPTY_COVERAGE
 
-    if not source_tree:
-        print("Couldn't find a test coverage file for " + lookup)
-        return []
+    return coverage_index[key]
 
-    # search for lines with coverage information
-    coverage_map = {}
-    for line in source_tree.findall("line"):
-        line_number = int(line.attrib["nr"])
-        # We considered Covered = True if there are no missed instructions(mi) or missed branches(mb) in jacoco's info
-        coverage_map[line_number] = (
-            line.attrib["mi"] == "0" and line.attrib["mb"] == "0"
-        )
 
-    return coverage_map
+def _has_coverage_info(file):
+    """Whether a changed file can have an entry in the coverage report"""
+    return "/" in file and _JAVA_PATH_RE.search(file) is not None
 
 
-def _get_git_diff(commit):
-    """Get a diff between a specified commit(or branch) and HEAD"""
-    return (
-        subprocess.check_output(["git", "diff", commit, "HEAD", "-U0"])
+def _get_changed_files(commit):
+    """List files changed between a commit and HEAD that can have coverage"""
+    changed_files = (
+        subprocess.check_output(
+            ["git", "diff", "--name-only", "--diff-filter=d", commit, "HEAD"]
+        )
         .decode(errors="ignore")
-        .strip()
+        .splitlines()
     )
+    return [file for file in changed_files if _has_coverage_info(file)]
 
 
-def _get_lines_changed(line_summary):
+def _get_git_diff(commit, files):
     """
-    Parse the line diff summary into a list of numbers representing line numbers added or changed
-    :param line_summary: the summary from a git diff of lines that have changed (ex: @@ -1,40 +1,23 @@)
-    :return: a list of integers indicating which lines changed for that summary
+    Stream raw diff lines between a specified commit(or branch) and HEAD for
+    the given files, so the whole diff is never buffered in memory. Deletions
+    are filtered out on the git side since they can never be covered.
     """
-    lines = re.search(r"\@\@.*?\+(.+?) \@\@", line_summary).group(1)
-    if "," in lines:
-        start, count = (int(x) for x in lines.split(","))
-        return list(range(start, start + count))
-    return [int(lines)]
-
-
-def _parse_file_diff(diff):
-    """Parse a single file's diff, return an object of that files name and the lines changed"""
-    file_name_info = re.search(r".*\+\+\+ b/(.+?)\s+", diff)
-
-    if not file_name_info or not file_name_info.group(1):
-        return None
-    file_name = file_name_info.group(1)
-
-    # find mapping of which lines where changed
-    diff_line_summaries = re.findall(r"\@\@.*?\@\@", diff)
-
-    # add line
-    added_lines = list(
-        chain.from_iterable([_get_lines_changed(s) for s in diff_line_summaries])
+    process = subprocess.Popen(
+        ["git", "diff", "--diff-filter=d", commit, "HEAD", "-U0", "--"] + files,
+        stdout=subprocess.PIPE,
     )
+    yield from process.stdout
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
 
-    return {"file": file_name, "lines_changed": added_lines}
+
+def _parse_diff(diff_lines):
+    """
+    Parse raw diff lines into a set of objects containing the file name and
+    changed lines. A single pass dispatching on the three interesting line
+    prefixes ('diff --git ', '+++ b/', '@@ ') replaces the layered regex scans.
+    """
+    changes = []
+    file_name = None
+    lines_changed = set()
+    for line in diff_lines:
+        if line.startswith(b"diff --git "):
+            if file_name is not None:
+                changes.append(
+                    {"file": file_name, "lines_changed": frozenset(lines_changed)}
+                )
+            file_name = None
+            lines_changed = set()
+        elif line.startswith(b"+++ b/"):
+            name = line[6:].decode(errors="ignore").split()
+            file_name = name[0] if name else None
+        elif line.startswith(b"@@ ") and file_name is not None:
+            # the added side of the hunk summary looks like +start[,count]
+            added = line.split(b" +", 1)[1].split(b" ", 1)[0]
+            start, _, count = added.partition(b",")
+            start = int(start)
+            lines_changed.update(
+                range(start, start + (int(count) if count else 1))
+            )
+    if file_name is not None:
+        changes.append(
+            {"file": file_name, "lines_changed": frozenset(lines_changed)}
+        )
+    return changes
 
 
-def _parse_diff(diff):
-    """Parse the raw diff string into a set of objects containing the file name and changed lines"""
-    file_diffs = re.split(r"\ndiff --git ", diff)
-    return [
-        file_info
-        for file_info in [_parse_file_diff(file_diff) for file_diff in file_diffs]
-        if file_info is not None
-    ]
+@functools.lru_cache(maxsize=4)
+def _get_diff_changes(commit):
+    """Get the parsed diff against a commit, only running the hunk diff for
+    files that can actually have coverage. Cached per commit so re-entrant
+    callers don't rerun git diff within one run."""
+    files = _get_changed_files(commit)
+    if not files:
+        return []
+    return _parse_diff(_get_git_diff(commit, files))
 
 
-def _reconcile_coverage(change, coverage_map):
+def _reconcile_coverage(change, file_coverage):
     """
-    Given an object with change and the coverage map for that file, produce information about coverage on lines changed
-    :param change: an object containing the file name and list of changed/added lines
-    :param coverage_map: a map int->boolean of line numbers to coverage status
-    :return: a counter of covered/uncovered/ignored lines
+    Given an object with change and the coverage info for that file, produce information about coverage on lines changed
+    :param change: an object containing the file name and set of changed/added lines
+    :param file_coverage: a FileCoverage of covered/uncovered line sets
+    :return: a LineStats of covered/uncovered/ignored line counts
     """
-    line_stats = Counter()
+    # set intersections keep the per-line work in C instead of a Python loop
+    changed = change["lines_changed"]
+    covered = len(changed & file_coverage.covered)
+    uncovered = len(changed & file_coverage.uncovered)
+    return LineStats(covered, uncovered, len(changed) - covered - uncovered)
 
-    for line in change["lines_changed"]:
-        if line not in coverage_map:
-            line_stats["ignored"] += 1
-        else:
-            if coverage_map[line]:
-                line_stats["covered"] += 1
-            else:
-                line_stats["uncovered"] += 1
 
-    return line_stats
+def _reconcile_change(coverage_report, change):
+    """Look up a change's coverage info and reconcile it, for use from a worker"""
+    file_coverage = _get_file_coverage(coverage_report, change["file"])
+    if file_coverage is None:
+        return change["file"], None
+    return change["file"], _reconcile_coverage(change, file_coverage)
 
 
 def get_coverage(line_stats):
-    denominator = line_stats["covered"] + line_stats["uncovered"]
+    denominator = line_stats.covered + line_stats.uncovered
     if denominator == 0:
         return None
-    return float(line_stats["covered"]) / denominator
+    return float(line_stats.covered) / denominator
 
 
 def get_file_message(file, buffer):
@@ -141,44 +200,35 @@ def get_file_message(file, buffer):
     name = file["file"]
     covered_lines = file["coverage"]
 
-    with open(name) as source_file:
-        content = source_file.readlines()
+    # linecache keeps the file contents cached across calls
+    content = linecache.getlines(name)
 
-    lines_to_display = []
+    # merge the display windows around each uncovered line into disjoint
+    # (first, last) line ranges in one pass over the sorted uncovered lines
+    ranges = []
     for line in file["uncovered_lines"]:
-        for i in range(max(0, line - buffer), min(len(content), line + buffer + 1)):
-            if i not in lines_to_display:
-                lines_to_display.append(i)
-
-    coverage = {}
-    for line in lines_to_display:
-        if line not in covered_lines:
-            coverage[line] = "  "
-        elif line in file["lines_changed"]:
-            coverage[line] = (
-                "✅" if line in covered_lines and covered_lines[line] else "❌"
-            )
+        low = max(0, line - buffer)
+        high = min(len(content), line + buffer + 1) - 1
+        if ranges and low <= ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], high))
         else:
-            coverage[line] = (
-                "✔️ " if line in covered_lines and covered_lines[line] else "✖️ "
-            )
+            ranges.append((low, high))
 
-    coverage = OrderedDict(sorted(coverage.items()))
-
-    groups = []
-    for i in coverage.keys():
-        if not groups or i > groups[-1][-1] + 1:
-            groups.append([i])
-        else:
-            groups[-1].append(i)
+    # precompute sets so each line is classified with single membership checks
+    known_lines = covered_lines.covered | covered_lines.uncovered
+    changed_lines = file["lines_changed"]
 
-    if groups:
+    if ranges:
         message = f"🚗 {name}\n"
-        for group in groups:
-            for line in group:
-                message += (
-                    f"\t{coverage[line]} {str(line)}\t\t{content[line - 1][:-1]}\n"
-                )
+        for low, high in ranges:
+            for line in range(low, high + 1):
+                if line not in known_lines:
+                    icon = "  "
+                elif line in changed_lines:
+                    icon = "✅" if line in covered_lines.covered else "❌"
+                else:
+                    icon = "✔️ " if line in covered_lines.covered else "✖️ "
+                message += f"\t{icon} {str(line)}\t\t{content[line - 1][:-1]}\n"
             message += "\n"
         return message
     return ""
@@ -188,22 +238,20 @@ def get_untested_line_info(diff_changes, coverage_report, buffer):
     """Gets a message which contains untested lines in the commit"""
     untested_lines = []
     for change in diff_changes:
-        coverage_map = _get_coverage_map(coverage_report, change["file"])
+        file_coverage = _get_file_coverage(coverage_report, change["file"])
         # no coverage = entirely untested
-        if coverage_map is None:
+        if file_coverage is None:
             continue
 
-        uncovered_lines = [
-            line
-            for line in change["lines_changed"]
-            if line in coverage_map and not coverage_map[line]
-        ]
+        uncovered_lines = sorted(
+            change["lines_changed"] & file_coverage.uncovered
+        )
         untested_lines.append(
             {
                 "file": change["file"],
                 "lines_changed": change["lines_changed"],
                 "uncovered_lines": uncovered_lines,
-                "coverage": coverage_map,
+                "coverage": file_coverage,
             }
         )
 
@@ -212,7 +260,7 @@ def get_untested_line_info(diff_changes, coverage_report, buffer):
 
 def get_required_lines_for_coverage(target_coverage, total_coverage, line_stats):
     missing_coverage = target_coverage - total_coverage
-    line_count = line_stats["covered"] + line_stats["uncovered"]
+    line_count = line_stats.covered + line_stats.uncovered
     return math.ceil(missing_coverage * line_count)
 
 
@@ -222,7 +270,7 @@ def get_target_diff_coverage(current_coverage, line_stats):
     required coverage to 75%-- this allows things like 2 uncovered lines in a 12-line MR. Otherwise,
     the diff coverage must be >= the current coverage in the main branch.
     """
-    if line_stats["uncovered"] > 5:
+    if line_stats.uncovered > 5:
         return current_coverage
     return 0.75
 
@@ -232,18 +280,25 @@ def get_diff_coverage(coverage_xml, commit, current_coverage):
     Given the jacoco coverage xml and a commit to diff against, find the percent of lines added/changed that were
     covered
     """
-    diff_changes = _parse_diff(_get_git_diff(commit))
+    diff_changes = _get_diff_changes(commit)
     coverage_report = _parse_coverage(coverage_xml)
 
     file_stats = {}
-    line_stats = Counter()
+    covered = uncovered = ignored = 0
 
-    # find coverage across git diff
-    for change in diff_changes:
-        coverage_map = _get_coverage_map(coverage_report, change["file"])
-        if coverage_map is not None:
-            file_stats[change["file"]] = _reconcile_coverage(change, coverage_map)
-            line_stats += file_stats[change["file"]]
+    # find coverage across git diff, reconciling files in parallel; the merge
+    # stays sequential so the totals don't race
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        results = executor.map(
+            lambda change: _reconcile_change(coverage_report, change), diff_changes
+        )
+        for file, stats in results:
+            if stats is not None:
+                file_stats[file] = stats
+                covered += stats.covered
+                uncovered += stats.uncovered
+                ignored += stats.ignored
+    line_stats = LineStats(covered, uncovered, ignored)
 
     total_coverage = get_coverage(line_stats)
     if total_coverage is None:
@@ -1,25 +1,83 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import functools
+import linecache
 import math
 import re
 import subprocess  # nosec
 import xml.etree.ElementTree as element_tree  # nosec
-from collections import Counter, OrderedDict
-from itertools import chain
+from collections import namedtuple
 
 IGNORED_PACKAGES = [".venv/", "target/"]
 
+# package/filename split, compiled once since it's matched against every
+# changed file
+_PY_PATH_RE = re.compile(r"(.*)\/(.*\.py)")
+
+# the top-level line rate plus a flat (package, file name) -> FileCoverage index
+CoverageReport = namedtuple("CoverageReport", ["line_rate", "files"])
+
+# the covered and uncovered line numbers of one source file, as sets so that
+# reconciliation is bulk set intersections instead of a per-line Python loop
+FileCoverage = namedtuple("FileCoverage", ["covered", "uncovered"])
+
+_EMPTY_COVERAGE = FileCoverage(frozenset(), frozenset())
+
+# plain int counts of reconciled lines; cheaper than a Counter in the hot path
+LineStats = namedtuple("LineStats", ["covered", "uncovered", "ignored"])
+
+
+@functools.lru_cache(maxsize=4)
 def _parse_coverage(file_name):
-    return element_tree.parse(file_name).getroot()  # nosec
+    """
+    Stream the coverage xml into a CoverageReport, clearing elements as we go so
+    the full report never sits in memory at once
+    """
+    line_rate = None
+    files = {}
+    package = None
+    for event, element in element_tree.iterparse(  # nosec
+        file_name, events=("start", "end")
+    ):
+        if event == "start":
+            if element.tag == "coverage":
+                line_rate = float(element.attrib["line-rate"])
+            elif element.tag == "package":
+                package = element.get("name")
+        elif element.tag == "class":
+            covered = set()
+            uncovered = set()
+            for line in element.find("lines").findall("line"):
+                line_number = int(line.attrib["number"])
+                if line.attrib["hits"] == "1":
+                    covered.add(line_number)
+                else:
+                    uncovered.add(line_number)
+            files[(package, element.get("name"))] = FileCoverage(
+                frozenset(covered), frozenset(uncovered)
+            )
+            element.clear()
+        elif element.tag == "package":
+            element.clear()
+    return CoverageReport(line_rate, files)
+
 
+def _get_coverage_report(coverage_xml):
+    """Accept either a coverage xml filename or an already-parsed CoverageReport,
+    so callers that need both the total and the diff coverage only parse once"""
+    if isinstance(coverage_xml, str):
+        return _parse_coverage(coverage_xml)
+    return coverage_xml
 
-def _get_coverage_map(tree, file):
+
+def _get_file_coverage(coverage_index, file):
     """
-    Get a map of which lines are covered for a specified file
-    :param tree: an element tree for the coverage report xml
+    Get the coverage information for a specified file
+    :param coverage_index: the files index from a CoverageReport
     :param file: the file to find coverage for
-    :return: a map of int -> boolean with a key of lines we have info for and value of whether or not it's covered
+    :return: a FileCoverage of covered/uncovered line sets, or None if the file can't have coverage
     """
 
     # skip files that are in an ignored package or in the root directory
@@ -27,7 +85,7 @@ def _get_coverage_map(tree, file):
         return None
 
     # split file into package/filename as defined in jacoco's report
-    file_info = re.search(r"(.*)\/(.*\.py)", file)
+    file_info = _PY_PATH_RE.search(file)
 
     # skip files that don't match this, for example templates/info.html
     if not file_info or len(file_info.groups()) != 2:
@@ -35,130 +93,158 @@ def _get_coverage_map(tree, file):
 
     package, file_name = file_info.groups()
 
-    # look up the source file info in the report
-    lookup = 'package[@name="{}"]/classes/class[@name="{}"]'.format(
-        package.replace("/", "."), file_name
-    )
-    source_tree = tree.find(lookup)
+    # look up the source file info in the index
+    key = (package.replace("/", "."), file_name)
+    if key not in coverage_index:
+        print("Couldn't find a test coverage file for " + "/".join(key))
+        return _EMPTY_COVERAGE
 
-    if not source_tree:
-        print("Couldn't find a test coverage file for " + lookup)
-        return []
+    return coverage_index[key]
 
-    # search for lines with coverage information
-    coverage_map = {}
-    for line in source_tree.find("lines").findall("line"):
-        line_number = int(line.attrib["number"])
-        coverage_map[line_number] = line.attrib["hits"] == "1"
 
-    return coverage_map
+def _has_coverage_info(file):
+    """Whether a changed file can have an entry in the coverage report"""
+    return (
+        not any(file.startswith(package) for package in IGNORED_PACKAGES)
+        and "/" in file
+        and _PY_PATH_RE.search(file) is not None
+    )
 
 
-def _get_git_diff(commit):
-    """Get a diff between a specified commit(or branch) and HEAD"""
-    return (
-        subprocess.check_output(["git", "diff", commit, "HEAD", "-U0"])  # nosec
+def _get_changed_files(commit):
+    """List files changed between a commit and HEAD that can have coverage"""
+    changed_files = (
+        subprocess.check_output(  # nosec
+            ["git", "diff", "--name-only", "--diff-filter=d", commit, "HEAD"]
+        )
         .decode(errors="ignore")
-        .strip()
+        .splitlines()
     )
+    return [file for file in changed_files if _has_coverage_info(file)]
 
 
-def _get_lines_changed(line_summary):
+def _get_git_diff(commit, files):
     """
-    Parse the line diff summary into a list of numbers representing line numbers added or changed
-    :param line_summary: the summary from a git diff of lines that have changed (ex: @@ -1,40 +1,23 @@)
-    :return: a list of integers indicating which lines changed for that summary
+    Stream raw diff lines between a specified commit(or branch) and HEAD for
+    the given files, so the whole diff is never buffered in memory. Deletions
+    are filtered out on the git side since they can never be covered.
     """
-    lines = re.search(r"\@\@.*?\+(.+?) \@\@", line_summary).group(1)
-    if "," in lines:
-        start, count = [int(x) for x in lines.split(",")]
-        return list(range(start, start + count))
-    return [int(lines)]
-
-
-def _parse_file_diff(diff):
-    """Parse a single file's diff, return an object of that files name and the lines changed"""
-    file_name_info = re.search(r".*\+\+\+ b/(.+?)\s+", diff)
-
-    if not file_name_info or not file_name_info.group(1):
-        return None
-    file_name = file_name_info.group(1)
-
-    # find mapping of which lines where changed
-    diff_line_summaries = re.findall(r"\@\@.*?\@\@", diff)
-
-    # add line
-    added_lines = list(
-        chain.from_iterable([_get_lines_changed(s) for s in diff_line_summaries])
+    process = subprocess.Popen(  # nosec
+        ["git", "diff", "--diff-filter=d", commit, "HEAD", "-U0", "--"] + files,
+        stdout=subprocess.PIPE,
     )
+    yield from process.stdout
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
 
-    return {"file": file_name, "lines_changed": added_lines}
+
+def _parse_diff(diff_lines):
+    """
+    Parse raw diff lines into a set of objects containing the file name and
+    changed lines. A single pass dispatching on the three interesting line
+    prefixes ('diff --git ', '+++ b/', '@@ ') replaces the layered regex scans.
+    """
+    changes = []
+    file_name = None
+    lines_changed = set()
+    for line in diff_lines:
+        if line.startswith(b"diff --git "):
+            if file_name is not None:
+                changes.append(
+                    {"file": file_name, "lines_changed": frozenset(lines_changed)}
+                )
+            file_name = None
+            lines_changed = set()
+        elif line.startswith(b"+++ b/"):
+            name = line[6:].decode(errors="ignore").split()
+            file_name = name[0] if name else None
+        elif line.startswith(b"@@ ") and file_name is not None:
+            # the added side of the hunk summary looks like +start[,count]
+            added = line.split(b" +", 1)[1].split(b" ", 1)[0]
+            start, _, count = added.partition(b",")
+            start = int(start)
+            lines_changed.update(
+                range(start, start + (int(count) if count else 1))
+            )
+    if file_name is not None:
+        changes.append(
+            {"file": file_name, "lines_changed": frozenset(lines_changed)}
+        )
+    return changes
 
 
-def _parse_diff(diff):
-    """Parse the raw diff string into a set of objects containing the file name and changed lines"""
-    file_diffs = re.split(r"\ndiff --git ", diff)
-    return [
-        file_info
-        for file_info in [_parse_file_diff(file_diff) for file_diff in file_diffs]
-        if file_info is not None
-    ]
+@functools.lru_cache(maxsize=4)
+def _get_diff_changes(commit):
+    """Get the parsed diff against a commit, only running the hunk diff for
+    files that can actually have coverage. Cached per commit so re-entrant
+    callers don't rerun git diff within one run."""
+    files = _get_changed_files(commit)
+    if not files:
+        return []
+    return _parse_diff(_get_git_diff(commit, files))
 
 
-def _reconcile_coverage(change, coverage_map):
+def _reconcile_coverage(change, file_coverage):
     """
-    Given an object with change and the coverage map for that file, produce information about coverage on lines
+    Given an object with change and the coverage info for that file, produce information about coverage on lines
     changed.
 
-    :param change: an object containing the file name and list of changed/added lines
-    :param coverage_map: a map int->boolean of line numbers to coverage status
-    :return: a counter of covered/uncovered/ignored lines
+    :param change: an object containing the file name and set of changed/added lines
+    :param file_coverage: a FileCoverage of covered/uncovered line sets
+    :return: a LineStats of covered/uncovered/ignored line counts
     """
-    line_stats = Counter()
+    # set intersections keep the per-line work in C instead of a Python loop
+    changed = change["lines_changed"]
+    covered = len(changed & file_coverage.covered)
+    uncovered = len(changed & file_coverage.uncovered)
+    return LineStats(covered, uncovered, len(changed) - covered - uncovered)
 
-    for line in change["lines_changed"]:
-        if line not in coverage_map:
-            line_stats["ignored"] += 1
-        else:
-            if coverage_map[line]:
-                line_stats["covered"] += 1
-            else:
-                line_stats["uncovered"] += 1
 
-    return line_stats
+def _reconcile_change(coverage_report, change):
+    """Look up a change's coverage info and reconcile it, for use from a worker"""
+    file_coverage = _get_file_coverage(coverage_report, change["file"])
+    if file_coverage is None:
+        return change["file"], None
+    return change["file"], _reconcile_coverage(change, file_coverage)
 
 
 def get_coverage(line_stats):
-    denominator = line_stats["covered"] + line_stats["uncovered"]
+    denominator = line_stats.covered + line_stats.uncovered
     if denominator == 0:
         return None
-    return float(line_stats["covered"]) / denominator
+    return float(line_stats.covered) / denominator
 
 
-def get_lines_to_display(file, buffer, content):
-    lines_to_display = []
+def get_display_ranges(file, buffer, content):
+    """Merge the display windows around each uncovered line into disjoint
+    (first, last) line ranges in one pass over the sorted uncovered lines"""
+    ranges = []
     for line in file["uncovered_lines"]:
-        for i in range(max(0, line - buffer), min(len(content), line + buffer + 1)):
-            if i not in lines_to_display:
-                lines_to_display.append(i)
-    return lines_to_display
+        low = max(0, line - buffer)
+        high = min(len(content), line + buffer + 1) - 1
+        if ranges and low <= ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], high))
+        else:
+            ranges.append((low, high))
+    return ranges
 
 
 def get_coverage_icons(lines_to_display, covered_lines, file):
+    # precompute sets so each line is classified with single membership checks
+    known_lines = covered_lines.covered | covered_lines.uncovered
+    changed_lines = file["lines_changed"]
+
+    # lines_to_display is already sorted, so the dict is built in line order
     coverage = {}
     for line in lines_to_display:
-        if line not in covered_lines:
+        if line not in known_lines:
             coverage[line] = "  "
-        elif line in file["lines_changed"]:
-            coverage[line] = (
-                "✅" if line in covered_lines and covered_lines[line] else "❌"
-            )
+        elif line in changed_lines:
+            coverage[line] = "✅" if line in covered_lines.covered else "❌"
         else:
-            coverage[line] = (
-                "✔️ " if line in covered_lines and covered_lines[line] else "✖️ "
-            )
+            coverage[line] = "✔️ " if line in covered_lines.covered else "✖️ "
 
-    return OrderedDict(sorted(coverage.items()))
+    return coverage
 
 
 def get_file_message(file, buffer):
@@ -166,23 +252,17 @@ def get_file_message(file, buffer):
     name = file["file"]
     covered_lines = file["coverage"]
 
-    with open(name) as source_file:
-        content = source_file.readlines()
+    # linecache keeps the file contents cached across calls
+    content = linecache.getlines(name)
 
-    lines_to_display = get_lines_to_display(file, buffer, content)
+    ranges = get_display_ranges(file, buffer, content)
+    lines_to_display = [line for low, high in ranges for line in range(low, high + 1)]
     coverage_icons = get_coverage_icons(lines_to_display, covered_lines, file)
 
-    groups = []
-    for i in coverage_icons.keys():
-        if not groups or i > groups[-1][-1] + 1:
-            groups.append([i])
-        else:
-            groups[-1].append(i)
-
-    if groups:
+    if ranges:
         message = f"🚗 {name}\n"
-        for group in groups:
-            for line in group:
+        for low, high in ranges:
+            for line in range(low, high + 1):
                 message += f"\t{coverage_icons[line]} {str(line)}\t\t{content[line - 1][:-1]}\n"
             message += "\n"
         return message
@@ -193,22 +273,20 @@ def get_untested_line_info(diff_changes, coverage_report, buffer):
     """Gets a message which contains untested lines in the commit"""
     untested_lines = []
     for change in diff_changes:
-        coverage_map = _get_coverage_map(coverage_report, change["file"])
+        file_coverage = _get_file_coverage(coverage_report, change["file"])
         # no coverage = entirely untested
-        if coverage_map is None:
+        if file_coverage is None:
             continue
 
-        uncovered_lines = [
-            line
-            for line in change["lines_changed"]
-            if line in coverage_map and not coverage_map[line]
-        ]
+        uncovered_lines = sorted(
+            change["lines_changed"] & file_coverage.uncovered
+        )
         untested_lines.append(
             {
                 "file": change["file"],
                 "lines_changed": change["lines_changed"],
                 "uncovered_lines": uncovered_lines,
-                "coverage": coverage_map,
+                "coverage": file_coverage,
             }
         )
 
@@ -217,7 +295,7 @@ def get_untested_line_info(diff_changes, coverage_report, buffer):
 
 def get_required_lines_for_coverage(target_coverage, total_coverage, line_stats):
     missing_coverage = target_coverage - total_coverage
-    line_count = line_stats["covered"] + line_stats["uncovered"]
+    line_count = line_stats.covered + line_stats.uncovered
     return math.ceil(missing_coverage * line_count)
 
 
@@ -227,18 +305,25 @@ def get_diff_coverage(coverage_xml, commit, target_coverage):
     covered
     """
 
-    diff_changes = _parse_diff(_get_git_diff(commit))
-    coverage_report = _parse_coverage(coverage_xml).find("packages")
+    diff_changes = _get_diff_changes(commit)
+    coverage_report = _get_coverage_report(coverage_xml).files
 
     file_stats = {}
-    line_stats = Counter()
+    covered = uncovered = ignored = 0
 
-    # find coverage across git diff
-    for change in diff_changes:
-        coverage_map = _get_coverage_map(coverage_report, change["file"])
-        if coverage_map is not None:
-            file_stats[change["file"]] = _reconcile_coverage(change, coverage_map)
-            line_stats += file_stats[change["file"]]
+    # find coverage across git diff, reconciling files in parallel; the merge
+    # stays sequential so the totals don't race
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        results = executor.map(
+            lambda change: _reconcile_change(coverage_report, change), diff_changes
+        )
+        for file, stats in results:
+            if stats is not None:
+                file_stats[file] = stats
+                covered += stats.covered
+                uncovered += stats.uncovered
+                ignored += stats.ignored
+    line_stats = LineStats(covered, uncovered, ignored)
 
     total_coverage = get_coverage(line_stats)
     if total_coverage is None:
@@ -261,8 +346,12 @@ def get_diff_coverage(coverage_xml, commit, target_coverage):
 
 
 def get_total_coverage(coverage_xml):
-    coverage_report = _parse_coverage(coverage_xml)
-    return float(coverage_report.attrib["line-rate"]) * 100
+    if not isinstance(coverage_xml, str):
+        return coverage_xml.line_rate * 100
+    # only the root line-rate attribute is needed, so stop parsing at the first
+    # start tag instead of building the whole coverage index
+    for _, element in element_tree.iterparse(coverage_xml, events=("start",)):  # nosec
+        return float(element.attrib["line-rate"]) * 100
 
 
 def main():